@@ -1,15 +1,40 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
+import itertools
 import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import AsyncIterator, Iterator
 
 import anthropic
 import attrs
+import diskcache
+import httpx
 import pdf2image
+import pypdfium2 as pdfium
 import pytesseract
+from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
+from anthropic.types.messages.batch_create_params import Request
+from PIL import Image
 from pypdf import PdfReader
 
 import config
 
-AiClient = anthropic.Anthropic
+AiClient = anthropic.AsyncAnthropic
+
+# A pdf whose first few pages hold less text than this is treated as a scan
+_PROBE_PAGES = 3
+_PROBE_MIN_CHARS = 100
+
+_CHARS_PER_TOKEN = 4
+_CONTEXT_TOKENS = 200_000
 
 # configure logging
 logger = logging.getLogger(__name__)
@@ -24,7 +49,6 @@ class AiReader:
     file: str | Path | None = None
     model: str = "claude-3-opus-20240229"
     text: str | None = None
-    client: AiClient = attrs.field(init=False)
     api_key: str | None = None
 
     def __attrs_post_init__(self):
@@ -33,64 +57,524 @@ class AiReader:
 
         if "claude" in self.model:
             self.api_key = self.api_key or config.ANTHROPIC_API_KEY
-            self.client = anthropic.Anthropic(api_key=self.api_key)
         else:
             raise NotImplementedError(f"Model {self.model} not supported")
 
+    @property
+    def client(self) -> AiClient:
+        """The shared client for this reader's API key on the running event loop, or
+        on the loop behind the blocking methods when read outside one."""
+        return _client_for(self.api_key)
+
+    # The plain methods block until they finish and can be called from synchronous
+    # code. Their `a`-prefixed counterparts are coroutines for use inside a running
+    # event loop.
+
     def summarize(
         self, prompt: str = "Please summarize the text.", max_tokens: int = 2048
     ) -> str:
-        return summarize_text(self.text, prompt, self.client, self.model, max_tokens)
+        return _run(self.asummarize(prompt, max_tokens))
+
+    async def asummarize(
+        self, prompt: str = "Please summarize the text.", max_tokens: int = 2048
+    ) -> str:
+        async with _using_client(self.api_key) as client:
+            return await summarize_text(
+                self.text, prompt, client, self.model, max_tokens
+            )
+
+    def summarize_many(
+        self,
+        texts: list[str],
+        prompt: str = "Please summarize the text.",
+        max_tokens: int = 2048,
+    ) -> list[str]:
+        return _run(self.asummarize_many(texts, prompt, max_tokens))
+
+    async def asummarize_many(
+        self,
+        texts: list[str],
+        prompt: str = "Please summarize the text.",
+        max_tokens: int = 2048,
+    ) -> list[str]:
+        """Summarize several texts concurrently, returning summaries in input order."""
+        async with _using_client(self.api_key) as client:
+            return await asyncio.gather(
+                *[
+                    summarize_text(text, prompt, client, self.model, max_tokens)
+                    for text in texts
+                ]
+            )
+
+    def summarize_batch(
+        self,
+        texts: list[str],
+        prompt: str = "Please summarize the text.",
+        max_tokens: int = 2048,
+    ) -> list[str | None]:
+        return _run(self.asummarize_batch(texts, prompt, max_tokens))
+
+    async def asummarize_batch(
+        self,
+        texts: list[str],
+        prompt: str = "Please summarize the text.",
+        max_tokens: int = 2048,
+    ) -> list[str | None]:
+        async with _using_client(self.api_key) as client:
+            return await summarize_batch(texts, prompt, client, self.model, max_tokens)
+
+
+@attrs.define
+class RateLimiter:
+    """Client-side throttle that gates requests before they are sent.
+
+    Requests are limited by a concurrency cap plus requests-per-minute and
+    tokens-per-minute sliding windows, defaulting to Anthropic's entry tier. The
+    concurrency cap follows AIMD: it grows by `increase` after each successful
+    request and is scaled by `decrease` whenever the API answers with a 429.
+    """
+
+    rpm: int = 50
+    tpm: int = 80_000
+    max_concurrent: int = 5
+    increase: float = 0.1
+    decrease: float = 0.5
+    window: float = 60.0
+    concurrency: float = attrs.field(init=False)
+    _in_flight: int = attrs.field(init=False, default=0)
+    _requests: deque[float] = attrs.field(init=False, factory=deque)
+    _tokens: deque[tuple[float, int]] = attrs.field(init=False, factory=deque)
+    _token_total: int = attrs.field(init=False, default=0)
+
+    def __attrs_post_init__(self):
+        self.concurrency = float(self.max_concurrent)
+
+    async def acquire(self, tokens: int):
+        while True:
+            now = time.monotonic()
+            self._expire(now)
+            if (
+                self._in_flight < int(self.concurrency)
+                and len(self._requests) < self.rpm
+                # Always admit a request into an empty window, however large
+                and (self._token_total + tokens <= self.tpm or not self._tokens)
+            ):
+                self._in_flight += 1
+                self._requests.append(now)
+                self._tokens.append((now, tokens))
+                self._token_total += tokens
+                return
+
+            if self._in_flight >= int(self.concurrency):
+                delay = 0.05
+            else:
+                delay = self._requests[0] + self.window - now
+            await asyncio.sleep(max(delay, 0.01))
+
+    def release(self, throttled: bool | None = False):
+        """Free a slot. Pass `throttled=None` for requests that neither succeeded nor
+        hit a 429, such as cancelled or failed ones, to leave the cap unchanged."""
+        self._in_flight -= 1
+        if throttled is None:
+            return
+        if throttled:
+            self.concurrency = max(1.0, self.concurrency * self.decrease)
+        else:
+            self.concurrency = min(
+                float(self.max_concurrent), self.concurrency + self.increase
+            )
+
+    def _expire(self, now: float):
+        while self._requests and self._requests[0] <= now - self.window:
+            self._requests.popleft()
+        while self._tokens and self._tokens[0][0] <= now - self.window:
+            self._token_total -= self._tokens.popleft()[1]
 
 
-def get_response(
+# Rate limits apply to the whole API key, so every request shares one limiter
+# unless told otherwise.
+default_limiter = RateLimiter()
+
+
+# Pooled connections belong to the event loop that opened them, so clients are
+# shared per loop, along with a count of the calls currently using each one
+_clients: dict[tuple[asyncio.AbstractEventLoop, str], AiClient] = {}
+_client_users: Counter[tuple[asyncio.AbstractEventLoop, str]] = Counter()
+
+
+def _client_for(api_key: str) -> AiClient:
+    # Readers share one client per key, and with it one pool of connections, so
+    # each new reader doesn't repeat connection and TLS setup. HTTP/2 lets
+    # concurrent requests share a single connection.
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = _get_loop()
+
+    # A closed loop's client can no longer be closed, so just let go of it
+    for key in [key for key in _clients if key[0].is_closed()]:
+        del _clients[key]
+        del _client_users[key]
+
+    if (loop, api_key) not in _clients:
+        _clients[loop, api_key] = AiClient(
+            api_key=api_key,
+            # get_response does its own retries so that the rate limiter sees them
+            max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                http2=True, limits=httpx.Limits(max_connections=20)
+            ),
+        )
+    return _clients[loop, api_key]
+
+
+@contextlib.asynccontextmanager
+async def _using_client(api_key: str) -> AsyncIterator[AiClient]:
+    """Hold the running loop's client for the duration of a call.
+
+    The last call to finish closes the client, since its connections can't be closed
+    once the loop itself has been, e.g. at the end of `asyncio.run`. The one
+    exception is the loop behind the blocking methods, which lives as long as the
+    process and so keeps its connections between calls.
+    """
+    client = _client_for(api_key)
+    key = (asyncio.get_running_loop(), api_key)
+    _client_users[key] += 1
+    try:
+        yield client
+    finally:
+        _client_users[key] -= 1
+        if not _client_users[key] and key[0] is not _loop:
+            del _client_users[key]
+            if _clients.get(key) is client:
+                del _clients[key]
+            await client.close()
+
+
+# A single loop for the sync wrappers, so that successive calls keep reusing the
+# same client and its connections rather than starting over on a fresh loop.
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop
+
+
+def _run(coro):
+    return _get_loop().run_until_complete(coro)
+
+
+async def get_response(
     prompt: str,
-    client: anthropic.Anthropic,
+    client: AiClient,
     model: str = "claude-3-opus-20240229",
     max_tokens: int = 2048,
+    limiter: RateLimiter | None = None,
+    retries: int = 5,
+    system: str | None = None,
 ) -> str:
-    return (
-        client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            messages=[{"role": "user", "content": prompt}],
-        )
-        .content[0]
-        .text
+    """Send a single prompt to the model and return the text of its reply.
+
+    Replies are cached on disk by model, token limit and prompt, so repeated calls
+    return without touching the API. A `system` prompt is marked for Anthropic's
+    prompt caching, so long content reused across several prompts is only billed in
+    full once.
+    """
+    cache = _response_cache()
+    key = hashlib.sha256(
+        f"{model}|{max_tokens}|{system or ''}|{prompt}".encode()
+    ).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    system_blocks = (
+        [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+        if system
+        else anthropic.NOT_GIVEN
     )
+    limiter = default_limiter if limiter is None else limiter
+    tokens = estimate_tokens((system or "") + prompt) + max_tokens
+    attempt = 0
+    while True:
+        await limiter.acquire(tokens)
+        throttled = None
+        try:
+            response = await client.messages.create(
+                model=model,
+                max_tokens=max_tokens,
+                system=system_blocks,
+                messages=[{"role": "user", "content": prompt}],
+            )
+            throttled = False
+        except anthropic.RateLimitError as error:
+            throttled = True
+            if attempt >= retries:
+                raise
+            reason = "Rate limited"
+            retry_after = _retry_after(error)
+        except (anthropic.InternalServerError, anthropic.APIConnectionError) as error:
+            # Overloaded, server and connection errors are transient but say nothing
+            # about our rate, so they are retried without touching the limiter's cap
+            if attempt >= retries:
+                raise
+            reason = f"Request failed ({type(error).__name__})"
+            retry_after = _retry_after(error)
+        finally:
+            # Also runs on errors and cancellation, which would otherwise leak the slot
+            limiter.release(throttled)
+
+        if throttled is False:
+            cache[key] = reply = response.content[0].text
+            return reply
+        delay = 2**attempt if retry_after is None else retry_after
+        attempt += 1
+        logger.info(f"{reason}, retrying in {delay}s...")
+        await asyncio.sleep(delay)
+
+
+def _retry_after(error: anthropic.APIError) -> float | None:
+    if not isinstance(error, anthropic.APIStatusError):
+        return None
+    try:
+        return float(error.response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+@functools.cache
+def _response_cache() -> diskcache.Cache:
+    return diskcache.Cache(Path("~/.cache/speedread").expanduser())
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, at about four characters per token."""
+    return len(text) // _CHARS_PER_TOKEN + 1
 
 
 def read_file(file: str | Path) -> str:
     if not file:
         raise ValueError("No file path provided")
-    if file.endswith(".pdf"):
+    suffix = Path(file).suffix.lower()
+    if suffix == ".pdf":
         logger.info(f"Reading pdf file...")
-        reader = PdfReader(file)
-        text = "".join([page.extract_text() for page in reader.pages])
+        text = text_from_pdf(file)
         if not text:
             logger.info("No text found in pdf, attempting to extract from images...")
             text = text_from_images(file)
-    elif file.endswith(".txt"):
+    elif suffix == ".txt":
         logger.info(f"Reading txt file...")
         with open(file, "r") as f:
             text = f.read()
     else:
-        raise NotImplementedError(f"File type {file.split('.')[-1]} not supported")
+        raise NotImplementedError(f"File type {suffix} not supported")
 
     return text
 
 
-def summarize_text(
-    text: str, prompt: str, client: AiClient, model: str, max_tokens: int
+async def aread_file(file: str | Path) -> str:
+    """Read a file in a worker thread so that parsing and OCR don't block the event
+    loop while requests are in flight."""
+    return await asyncio.to_thread(read_file, file)
+
+
+def text_from_pdf(file: str | Path) -> str:
+    """Extract the text layer of a pdf.
+
+    Only the first few pages are read before deciding whether the pdf is a scan, so
+    an empty string is returned for scans without walking every empty page.
+    """
+    pages = _iter_page_text(file)
+    probe = "".join(itertools.islice(pages, _PROBE_PAGES))
+    next_page = next(pages, None)
+    if next_page is None:
+        return probe
+    if len(probe.strip()) < _PROBE_MIN_CHARS:
+        pages.close()
+        return ""
+    return probe + next_page + "".join(pages)
+
+
+def _iter_page_text(file: str | Path) -> Iterator[str]:
+    # pdfium is C-backed and several times faster than pypdf, which is kept as a
+    # fallback for files pdfium refuses. Both read pages from a single shared
+    # document handle, so extraction stays serial.
+    try:
+        pdf = pdfium.PdfDocument(file)
+    except pdfium.PdfiumError:
+        logger.info("pdfium could not open the pdf, falling back to pypdf...")
+        for page in PdfReader(file).pages:
+            yield page.extract_text() or ""
+        return
+
+    try:
+        for page in pdf:
+            yield page.get_textpage().get_text_bounded()
+    finally:
+        pdf.close()
+
+
+def build_prompt(text: str, prompt: str) -> str:
+    return f"{build_context(text)}\n{prompt}"
+
+
+def build_context(text: str) -> str:
+    return f"Here is the contents of a pdf <content>{text}</content>"
+
+
+async def summarize_text(
+    text: str,
+    prompt: str,
+    client: AiClient,
+    model: str,
+    max_tokens: int,
+    limiter: RateLimiter | None = None,
 ) -> str:
-    full_prompt = f"Here is the contents of a pdf <content>{text}</content>"
-    full_prompt += f"/n{prompt}"
-    return get_response(full_prompt, client, model, max_tokens)
+    limiter = default_limiter if limiter is None else limiter
+    chunk_prompt = (
+        "This is one part of a longer document. Summarize it, keeping the details "
+        f"needed to respond to the following request about the whole document: {prompt}"
+    )
+    # Every request, reply included, has to fit in both the context window and one
+    # tokens-per-minute window, or the limiter could never admit it. Estimates round
+    # up once per string, hence the extra token.
+    budget = (
+        min(limiter.tpm, _CONTEXT_TOKENS)
+        - max_tokens
+        - estimate_tokens(build_prompt("", chunk_prompt))
+        - 1
+    )
+    if budget <= 0:
+        raise ValueError(
+            f"max_tokens={max_tokens} leaves no room for text within "
+            f"{limiter.tpm} tokens per minute"
+        )
+
+    chunks = _chunk(text, budget)
+    if len(chunks) == 1:
+        # The document goes in the system prompt so that it is prompt-cached across
+        # several prompts against the same text
+        return await get_response(
+            prompt,
+            client,
+            model,
+            max_tokens,
+            limiter=limiter,
+            system=build_context(text),
+        )
+
+    # Too long for one request: summarize the parts concurrently, then summarize
+    # the summaries
+    logger.info(
+        f"Text too long for a single request, summarizing in {len(chunks)} parts..."
+    )
+    summaries = await asyncio.gather(
+        *[
+            get_response(
+                build_prompt(chunk, chunk_prompt),
+                client,
+                model,
+                max_tokens,
+                limiter=limiter,
+            )
+            for chunk in chunks
+        ]
+    )
+    return await summarize_text(
+        "\n\n".join(summaries), prompt, client, model, max_tokens, limiter
+    )
+
+
+def _chunk(text: str, max_tokens: int) -> list[str]:
+    """Split text into pieces of at most `max_tokens` estimated tokens, breaking
+    between paragraphs where possible."""
+    max_chars = max_tokens * _CHARS_PER_TOKEN
+    chunks = []
+    current: list[str] = []
+    size = 0
+    for paragraph in text.split("\n\n"):
+        # Paragraphs that don't fit in a chunk on their own are cut wherever they must
+        pieces = [
+            paragraph[i : i + max_chars] for i in range(0, len(paragraph), max_chars)
+        ] or [""]
+        for piece in pieces:
+            if current and size + len(piece) > max_chars:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 2
+    chunks.append("\n\n".join(current))
+    return chunks
+
+
+async def summarize_batch(
+    texts: list[str],
+    prompt: str,
+    client: AiClient,
+    model: str,
+    max_tokens: int,
+    poll_interval: float = 20,
+) -> list[str | None]:
+    """Summarize texts through the Message Batches API.
+
+    Batches are billed at half the price of regular requests but can take a while to
+    process, so this suits bulk offline summarization. Summaries are returned in input
+    order; requests that did not succeed are logged and returned as None.
+    """
+    requests = [
+        Request(
+            custom_id=f"doc-{i}",
+            params=MessageCreateParamsNonStreaming(
+                model=model,
+                max_tokens=max_tokens,
+                messages=[{"role": "user", "content": build_prompt(text, prompt)}],
+            ),
+        )
+        for i, text in enumerate(texts)
+    ]
+    batch = await client.messages.batches.create(requests=requests)
+    logger.info(f"Submitted batch {batch.id}, waiting for it to finish...")
+    while batch.processing_status != "ended":
+        await asyncio.sleep(poll_interval)
+        batch = await client.messages.batches.retrieve(batch.id)
+
+    summaries: list[str | None] = [None] * len(texts)
+    async for response in await client.messages.batches.results(batch.id):
+        index = int(response.custom_id.removeprefix("doc-"))
+        if response.result.type == "succeeded":
+            summaries[index] = response.result.message.content[0].text
+        else:
+            logger.warning(f"Request {response.custom_id} {response.result.type}")
+    return summaries
+
+
+# OCR already uses every core, so concurrent reads OCR one pdf at a time rather
+# than piling up process pools and open files
+_ocr_lock = threading.Lock()
 
 
 def text_from_images(file: str | Path) -> str:
-    images = pdf2image.convert_from_path(file)
-    text = ""
-    for image in images:
-        text += pytesseract.image_to_string(image)
+    # Render pages to disk rather than holding every decoded page in memory, and
+    # hand the workers paths, which are far cheaper to pickle than images
+    with _ocr_lock, tempfile.TemporaryDirectory() as tmpdir:
+        paths = pdf2image.convert_from_path(
+            file,
+            dpi=200,
+            output_folder=tmpdir,
+            paths_only=True,
+            fmt="jpeg",
+            thread_count=os.cpu_count(),
+        )
+        # Tesseract is CPU-bound, so OCR pages in separate processes
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            return "".join(pool.map(_ocr_page, paths, chunksize=4))
+
+
+def _ocr_page(path: str) -> str:
+    with Image.open(path) as image:
+        text = pytesseract.image_to_string(image)
+    os.unlink(path)
     return text
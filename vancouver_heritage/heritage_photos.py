@@ -1,43 +1,65 @@
 import csv
-from typing import List, Optional
+import functools
+from typing import Dict, List, Optional, Tuple
 
 import attrs
-import cattrs
+import lxml.html
 import requests
-from bs4 import BeautifulSoup
+from geopy.exc import GeopyError
+from geopy.extra.rate_limiter import RateLimiter
 from geopy.geocoders import Nominatim
 from geopy.location import Location as GeopyLocation
 from gmplot import gmplot
+from lxml import etree
+
+_WIKITABLE_XPATH = etree.XPath(
+    "//table[contains(concat(' ', normalize-space(@class), ' '), ' wikitable ')]"
+)
+_HEADER_XPATH = etree.XPath(".//th")
+
+_MAX_DESTINATIONS = 9
+
+# Reuse connections across requests rather than paying for a new TCP and TLS
+# handshake each time
+_session = requests.Session()
+
+# Nominatim's usage policy allows at most one request per second. A single geocoder
+# is shared, so its requests adapter keeps its connections alive between calls.
+_geocode = RateLimiter(
+    Nominatim(user_agent="joltex").geocode,
+    min_delay_seconds=1,
+)
+_geocoded: Dict[Tuple[str, str], GeopyLocation] = {}
+
+
+def _set_coordinates(location, attribute, geopy_location):
+    # Copy the coordinates onto the Location whenever it is geocoded, so that they
+    # are plain attribute reads for the plotting and export code
+    location.latitude = geopy_location.latitude if geopy_location else None
+    location.longitude = geopy_location.longitude if geopy_location else None
+    return geopy_location
 
 
 @attrs.define
 class Location:
     address: str
     city: str
-    geopy_location: Optional[GeopyLocation] = attrs.field(init=False)
     name: Optional[str] = attrs.field(default=None)
+    geopy_location: Optional[GeopyLocation] = attrs.field(
+        default=None, on_setattr=_set_coordinates
+    )
+    latitude: Optional[float] = attrs.field(init=False, default=None)
+    longitude: Optional[float] = attrs.field(init=False, default=None)
 
-    @geopy_location.default
-    def _geolocate(self):
-        try:
-            geolocator = Nominatim(user_agent="joltex")
-            return geolocator.geocode(f"{self.address}, {self.city}")
-        except:
-            return None
+    def __attrs_post_init__(self):
+        _set_coordinates(self, None, self.geopy_location)
 
-    @property
-    def latitude(self) -> Optional[float]:
-        if self.geopy_location:
-            return self.geopy_location.latitude
-        else:
-            return None
 
-    @property
-    def longitude(self) -> Optional[float]:
-        if self.geopy_location:
-            return self.geopy_location.longitude
-        else:
-            return None
+# Everything but the geocoder's raw result is exported to csv
+_csv_filter = attrs.filters.exclude(attrs.fields(Location).geopy_location)
+_CSV_FIELDS = [
+    field.name for field in attrs.fields(Location) if _csv_filter(field, None)
+]
 
 
 def get_locations_without_photos(
@@ -58,56 +80,117 @@ def get_locations_without_photos(
     :param city: City in which the addresses are located.
     :return: List of Location objects without associated photos.
     """
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, "html.parser")
-    tables = soup.findAll("table", {"class": "wikitable"})
-
-    locations_without_photos = []
-    for table in tables:
-        headers = [header.get_text(strip=True) for header in table.findAll("th")]
-
-        # Identify the table indices of the location and photo columns
-        photo_index = next(
-            (i for i, header in enumerate(headers) if photo_col in header), None
-        )
-        location_index = next(
-            (i for i, header in enumerate(headers) if location_col in header), None
-        )
+    response = _session.get(url)
+    tree = lxml.html.fromstring(response.content)
+
+    addresses = []
+    for table in _WIKITABLE_XPATH(tree):
+        # Identify the table indices of the location and photo columns in a single
+        # pass, stopping as soon as both are found
+        photo_index = location_index = None
+        for i, header in enumerate(_HEADER_XPATH(table)):
+            text = header.text_content()
+            if photo_index is None and photo_col in text:
+                photo_index = i
+            if location_index is None and location_col in text:
+                location_index = i
+            if photo_index is not None and location_index is not None:
+                break
 
         # If both columns are present, proceed to extract data
         if photo_index is not None and location_index is not None:
-            rows = table.findAll("tr")
-            for row in rows:
-                columns = row.findAll("td")
-                if len(columns) > max(photo_index, location_index):
-                    photo_column = columns[photo_index]
-                    address = columns[location_index].get_text(strip=True)
-                    if not photo_column.find("img"):
-                        locations_without_photos.append(
-                            Location(address=address, city=city)
-                        )
+            missing_photo_xpath = _missing_photo_xpath(photo_index, location_index)
+            addresses.extend(
+                cell.text_content().strip() for cell in missing_photo_xpath(table)
+            )
+
+    # Heritage lists often give several buildings the same address, so geocode each
+    # distinct address once and share the result
+    geopy_locations = {
+        address: geocode(address, city) for address in dict.fromkeys(addresses)
+    }
+    return [
+        Location(address=address, city=city, geopy_location=geopy_locations[address])
+        for address in addresses
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _missing_photo_xpath(photo_index: int, location_index: int) -> etree.XPath:
+    """Compile an XPath selecting the location cell of every table row that has both
+    columns but no image in its photo cell. XPath positions are 1-based."""
+    photo, location = photo_index + 1, location_index + 1
+    return etree.XPath(
+        f".//tr[td[{max(photo, location)}] and not(td[{photo}]//img)]/td[{location}]"
+    )
+
+
+def geocode(address: str, city: str) -> Optional[GeopyLocation]:
+    """Geocode an address, remembering successful results so that each address is only
+    requested once. Failures are not remembered, so they are retried on the next call.
 
-    return locations_without_photos
+    :param address: Street address.
+    :param city: City in which the address is located.
+    :return: The geocoded location, or None if it could not be found.
+    """
+    key = (address, city)
+    if key not in _geocoded:
+        try:
+            geopy_location = _geocode(f"{address}, {city}")
+        except GeopyError:
+            return None
+        if geopy_location is None:
+            return None
+        _geocoded[key] = geopy_location
+    return _geocoded[key]
+
+
+def geocode_all(locations: List[Location]):
+    """Geocode every Location that does not yet have a `geopy_location`, sharing a
+    single rate-limited geocoder between them
+
+    :param locations: List of Location objects to geocode in place.
+    """
+    for location in locations:
+        if location.geopy_location is None:
+            location.geopy_location = geocode(location.address, location.city)
 
 
 def generate_google_maps_url_for_ios(
     locations: List[Location], start_location: Optional[Location] = None
-) -> str:
-    """Generate a Google maps URL for a collection of locations that can be
+) -> List[str]:
+    """Generate Google maps URLs for a collection of locations that can be
     openned by the Google Maps iOS app
 
+    Google Maps accepts at most nine destinations per route, so longer routes are split
+    into several URLs, each starting where the previous one ends. Locations that could
+    not be geocoded are skipped.
+
     :param locations: List of Location objects with latitude and longitude attributes.
     :param start_location: Location to start from. If None, start at `locations[0]`.
-    :return: Google maps iOS URL with all locations.
+    :return: Google maps iOS URLs that together visit all locations.
     """
     start_location = start_location if start_location else locations[0]
-    start_str = f"{start_location.latitude},{start_location.longitude}"
-    destination_locations = "+to:".join(
-        [f"{loc.latitude},{loc.longitude}" for loc in locations]
-    )
-    url = f"comgooglemaps://?saddr={start_location}&daddr={destination_locations}"
+    start_str = _format_coordinates(start_location)
+    destinations = [
+        _format_coordinates(loc) for loc in locations if loc.latitude is not None
+    ]
+
+    urls = []
+    for i in range(0, len(destinations), _MAX_DESTINATIONS):
+        legs = destinations[i : i + _MAX_DESTINATIONS]
+        urls.append(f"comgooglemaps://?saddr={start_str}&daddr={'+to:'.join(legs)}")
+        start_str = legs[-1]
+
+    return urls
+
 
-    return url
+def _format_coordinates(location: Location) -> str:
+    # Six decimal places is ~10cm, plenty for a map pin and keeps URLs short. An empty
+    # string makes Google Maps use the current location instead.
+    if location.latitude is None:
+        return ""
+    return f"{location.latitude:.6f},{location.longitude:.6f}"
 
 
 def plot_locations_on_map(
@@ -126,8 +209,13 @@ def plot_locations_on_map(
     gmap = gmplot.GoogleMapPlotter(
         centre_location.latitude, centre_location.longitude, 13
     )
-    for location in locations:
-        gmap.marker(location.latitude, location.longitude, title=location.address)
+    markers = [
+        (location.latitude, location.longitude, location.address)
+        for location in locations
+        if location.latitude is not None
+    ]
+    for latitude, longitude, title in markers:
+        gmap.marker(latitude, longitude, title=title)
     gmap.draw(output_path)
 
 
@@ -138,14 +226,10 @@ def to_csv(locations: List[Location], output_path="./locations.csv"):
     :param locations: List of Location objects.
     :param output_path: Path to save csv file to.
     """
-    converter = cattrs.Converter()
-    hook = cattrs.gen.make_dict_unstructure_fn(
-        Location, converter, geopy_location=cattrs.gen.override(omit=True)
-    )
-    converter.register_unstructure_hook(Location, hook)
-    csv_data = [converter.unstructure(location) for location in locations]
-
     with open(output_path, "w", encoding="utf8", newline="") as fout:
-        csv_writer = csv.DictWriter(fout, fieldnames=csv_data[0].keys())
-        csv_writer.writeheader()
-        csv_writer.writerows(csv_data)
+        csv_writer = csv.writer(fout)
+        csv_writer.writerow(_CSV_FIELDS)
+        csv_writer.writerows(
+            attrs.astuple(location, filter=_csv_filter, recurse=False)
+            for location in locations
+        )